@@ -1,66 +1,235 @@
 import asyncio
-import time
+import os
 import httpx
 import json
 import logging
+import orjson
+import threading
+
+try:
+    # libuv-backed event loop; not available on Windows
+    import uvloop
+except ImportError:
+    uvloop = None
 
 # OpenTelemetry Imports
+# Only the lightweight API is imported here; the SDK, Cloud Trace exporter (gRPC, protobuf)
+# and instrumentation are imported inside configure_opentelemetry() to keep startup fast.
 from opentelemetry import trace
-from opentelemetry.sdk.resources import Resource
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.exporter.cloud_trace import CloudTraceSpanExporter
-from opentelemetry.instrumentation.httpx import HTTPXClientInstrumentor
 
 # --- Configure Logging ---
+class SamplingFilter(logging.Filter):
+    """
+    Lets through every WARNING-and-above record but only every Nth record below that,
+    to cap log volume (and per-record formatting) on hot paths.
+    """
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        self.count = 0
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        self.count += 1
+        return self.count % self.rate == 0
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Set LOG_SAMPLE_RATE=N to emit only every Nth INFO/DEBUG record. The filter goes on the
+# root handlers since logger-level filters don't see records propagated from child loggers.
+try:
+    _log_sample_rate = int(os.getenv("LOG_SAMPLE_RATE", "1"))
+except ValueError:
+    logger.warning("Invalid LOG_SAMPLE_RATE %r; logging every record.",
+                   os.getenv("LOG_SAMPLE_RATE"))
+    _log_sample_rate = 1
+if _log_sample_rate > 1:
+    for _handler in logging.getLogger().handlers:
+        _handler.addFilter(SamplingFilter(_log_sample_rate))
+
+# Set HTTP_TRANSPORT=aiohttp to route httpx requests through aiohttp's I/O path
+# (requires the httpx-aiohttp and opentelemetry-instrumentation-aiohttp-client packages)
+HTTP_TRANSPORT = os.getenv("HTTP_TRANSPORT", "httpx")
+
+# Host serving the demo JSON endpoint
+DEMO_BASE_URL = "https://jsonplaceholder.typicode.com"
+
+# Simulated latency in seconds, awaited alongside the HTTP fetch in main()
+WAIT_TIME = 0.5
+
 # --- Configure OpenTelemetry ---
+# Define your service resource attributes; every span shares the Resource built from them
+_RESOURCE_ATTRIBUTES = {
+    "service.name": "my-python-app",
+    "service.version": "1.0.0",
+    "environment": "development",
+    # You can add more attributes here, e.g., "host.name": "my-machine"
+}
+
+# Provider created by configure_opentelemetry(), so repeated calls don't re-instrument
+_PROVIDER = None
+
 def configure_opentelemetry():
     """
     Configures OpenTelemetry to send traces to Google Cloud Trace.
+    Returns the TracerProvider so the caller can flush and shut it down on exit.
+    Safe to call more than once; later calls return the already configured provider.
     """
-    # Define your service resource
-    resource = Resource.create({
-        "service.name": "my-python-app",
-        "service.version": "1.0.0",
-        "environment": "development",
-        # You can add more attributes here, e.g., "host.name": "my-machine"
-    })
+    global _PROVIDER
+    if _PROVIDER is not None:
+        return _PROVIDER
+
+    from opentelemetry.exporter.cloud_trace import CloudTraceSpanExporter
+    from opentelemetry.instrumentation.httpx import HTTPXClientInstrumentor
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import (
+        BatchSpanProcessor, ConsoleSpanExporter, SimpleSpanProcessor,
+    )
+    from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
 
-    # Set up the TracerProvider with the defined resource
-    provider = TracerProvider(resource=resource)
+    # Set up the TracerProvider with the defined resource.
+    # Unless OTEL_TRACES_SAMPLER picks a sampler (then the SDK builds it), use parent-based
+    # ratio sampling: every trace is kept unless OTEL_TRACES_SAMPLER_ARG lowers the ratio.
+    # Unsampled spans are non-recording, so attribute work on them can be skipped.
+    sampler = None
+    if "OTEL_TRACES_SAMPLER" not in os.environ:
+        ratio_arg = os.getenv("OTEL_TRACES_SAMPLER_ARG")
+        ratio = 1.0
+        if ratio_arg:
+            try:
+                ratio = float(ratio_arg)
+            except ValueError:
+                ratio = None
+            if ratio is None or not 0.0 <= ratio <= 1.0:
+                logger.warning("Invalid OTEL_TRACES_SAMPLER_ARG %r; sampling every trace.",
+                               ratio_arg)
+                ratio = 1.0
+        sampler = ParentBased(root=TraceIdRatioBased(ratio))
+    # shutdown_tracing() enforces a time limit, so skip the SDK's unbounded atexit hook
+    provider = TracerProvider(
+        resource=Resource.create(_RESOURCE_ATTRIBUTES),
+        sampler=sampler,
+        shutdown_on_exit=False,
+    )
 
     # Configure Cloud Trace Exporter
     # BatchSpanProcessor is recommended for production to buffer and send spans efficiently
+    # The SDK defaults (2048 queue, 5s delay, 512 batch) drop spans under bursts, so pass
+    # tuned values. A set OTEL_BSP_* env var wins: passing None lets the SDK read and
+    # validate it. No export timeout is passed, since the SDK doesn't enforce one.
     cloud_trace_exporter = CloudTraceSpanExporter()
-    span_processor = BatchSpanProcessor(cloud_trace_exporter)
+    span_processor = BatchSpanProcessor(
+        cloud_trace_exporter,
+        max_queue_size=None if "OTEL_BSP_MAX_QUEUE_SIZE" in os.environ else 4096,
+        schedule_delay_millis=None if "OTEL_BSP_SCHEDULE_DELAY" in os.environ else 1000,
+        max_export_batch_size=(None if "OTEL_BSP_MAX_EXPORT_BATCH_SIZE" in os.environ
+                               else 256),
+    )
     provider.add_span_processor(span_processor)
 
+    # For local debugging, also print spans to stdout as they end. This is added alongside,
+    # not instead of, the batch processor: SimpleSpanProcessor exports synchronously on the
+    # calling thread and should not become the Cloud Trace path in any environment.
+    if os.getenv("OTEL_DEBUG_CONSOLE"):
+        provider.add_span_processor(SimpleSpanProcessor(ConsoleSpanExporter()))
+
     # Set the global tracer provider
     trace.set_tracer_provider(provider)
 
     # Instrument httpx automatically
-    # This will create spans for HTTP requests made with httpx
-    HTTPXClientInstrumentor().instrument()
+    # This will create spans for HTTP requests made with httpx.
+    # Skip it if httpx is already instrumented, to avoid double-wrapping requests.
+    httpx_instrumentor = HTTPXClientInstrumentor()
+    if not httpx_instrumentor.is_instrumented_by_opentelemetry:
+        httpx_instrumentor.instrument()
+    if HTTP_TRANSPORT == "aiohttp":
+        # The aiohttp transport bypasses httpx's own, so trace it at the aiohttp layer
+        from opentelemetry.instrumentation.aiohttp_client import AioHttpClientInstrumentor
+        aiohttp_instrumentor = AioHttpClientInstrumentor()
+        if not aiohttp_instrumentor.is_instrumented_by_opentelemetry:
+            aiohttp_instrumentor.instrument()
 
     logger.info("OpenTelemetry configured successfully for Google Cloud Trace.")
+    _PROVIDER = provider
+    return provider
+
+def shutdown_tracing(provider, timeout_seconds=2.0):
+    """
+    Flushes buffered spans and shuts down the provider, giving up after timeout_seconds.
+    The SDK's force_flush() ignores its timeout, so the work runs in a daemon thread that
+    is abandoned if a slow Cloud Trace endpoint doesn't answer in time.
+    Returns True if the shutdown finished.
+    """
+    def flush_and_shutdown():
+        provider.force_flush()
+        provider.shutdown()
+
+    worker = threading.Thread(target=flush_and_shutdown, daemon=True)
+    worker.start()
+    worker.join(timeout_seconds)
+    if worker.is_alive():
+        logger.warning(
+            "Timed out after %ss flushing spans; some may not have been exported.",
+            timeout_seconds,
+        )
+        return False
+    return True
 
 # Get a tracer from the configured provider
 tracer = trace.get_tracer(__name__)
 
-@tracer.start_as_current_span("simulate_half_second_wait")
+# Span attributes for wait_half_second, built once rather than on every call
+_WAIT_ATTRS = {"wait.duration.ms": int(WAIT_TIME * 1000)}
+
+# Shared HTTP client, created lazily so it picks up the httpx instrumentation and
+# keeps its connection pool warm across calls instead of re-doing TLS every time.
+_CLIENT = None
+
+def get_http_client():
+    """
+    Returns the shared httpx.AsyncClient, creating it on first use.
+    """
+    global _CLIENT
+    if _CLIENT is None:
+        limits = httpx.Limits(max_connections=100, max_keepalive_connections=20,
+                              keepalive_expiry=30.0)
+        transport = None
+        if HTTP_TRANSPORT == "aiohttp":
+            from httpx_aiohttp import AiohttpTransport
+            # httpx only applies limits= to its own transport, so hand them to aiohttp's
+            # connector here; the transport owns the session and aclose() closes it
+            transport = AiohttpTransport(limits=limits)
+        # HTTP/2 lets parallel requests share one connection (ignored by aiohttp)
+        _CLIENT = httpx.AsyncClient(
+            transport=transport,
+            http2=True,
+            limits=limits,
+            timeout=httpx.Timeout(10.0),
+        )
+    return _CLIENT
+
+async def close_http_client():
+    """
+    Closes the shared httpx.AsyncClient if it was created.
+    """
+    global _CLIENT
+    if _CLIENT is not None:
+        await _CLIENT.aclose()
+        _CLIENT = None
+
 async def wait_half_second():
     """
     A simple async function that waits for half a second.
     This will be a custom span in the trace.
     """
-    logger.info("Starting wait_half_second function...")
-    current_span = trace.get_current_span()
-    current_span.set_attribute("wait.duration.ms", 500)
-    await asyncio.sleep(0.5)
-    logger.info("Finished wait_half_second function.")
+    # Constant attributes are attached when the span starts, not set afterwards
+    with tracer.start_as_current_span("simulate_half_second_wait", attributes=_WAIT_ATTRS):
+        logger.info("Starting wait_half_second function...")
+        await asyncio.sleep(WAIT_TIME)
+        logger.info("Finished wait_half_second function.")
 
 @tracer.start_as_current_span("fetch_jsonplaceholder_post")
 async def call_demo_endpoint():
@@ -68,44 +237,57 @@ async def call_demo_endpoint():
     Uses httpx to call a demo JSON endpoint.
     The httpx instrumentation will automatically create a child span for the HTTP call.
     """
-    url = "https://jsonplaceholder.typicode.com/posts/1"
-    logger.info(f"Starting call_demo_endpoint function. Fetching from: {url}")
+    url = f"{DEMO_BASE_URL}/posts/1"
+    logger.info("Starting call_demo_endpoint function. Fetching from: %s", url)
 
     current_span = trace.get_current_span()
-    current_span.set_attribute("http.target.url", url)
+    # Collected here and applied with one set_attributes() call once the request is done
+    attrs = {"http.target.url": url}
 
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url)
+        # Read the body before raise_for_status() so e.response.text is available below
+        async with get_http_client().stream("GET", url) as response:
+            body = await response.aread()
             response.raise_for_status() # Raise an exception for HTTP errors
 
-            post_data = response.json()
-            logger.info("Successfully fetched data from demo endpoint.")
-            logger.debug("Fetched data: %s", json.dumps(post_data, indent=2))
+        # orjson's JSONDecodeError subclasses json's, so the handler below still applies
+        post_data = orjson.loads(body)
+        logger.info("Successfully fetched data from demo endpoint.")
+        # %-style args are still evaluated eagerly, so only build the dump when DEBUG is on
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Fetched data: %s",
+                         orjson.dumps(post_data, option=orjson.OPT_INDENT_2).decode())
 
-            current_span.set_attribute("http.status_code", response.status_code)
-            current_span.set_attribute("post.id", post_data.get("id"))
-            current_span.set_attribute("post.title", post_data.get("title"))
+        if current_span.is_recording():
+            attrs.update({
+                "http.status_code": response.status_code,
+                "post.id": post_data.get("id"),
+                "post.title": post_data.get("title"),
+            })
 
     except httpx.HTTPStatusError as e:
+        # Expected failures: the message says enough, so skip formatting a traceback
         logger.error(
             "HTTP error occurred: %s - %s",
-            e.response.status_code, e.response.text, exc_info=True
+            e.response.status_code, e.response.text
         )
         current_span.set_status(trace.Status(trace.StatusCode.ERROR,
                                               f"HTTP Error: {e.response.status_code}"))
     except httpx.RequestError as e:
-        logger.error("Network error occurred: %s", e, exc_info=True)
+        logger.error("Network error occurred: %s", e)
         current_span.set_status(trace.Status(trace.StatusCode.ERROR,
                                               f"Network Error: {e}"))
     except json.JSONDecodeError as e:
-        logger.error("JSON decoding error: %s", e, exc_info=True)
+        logger.error("JSON decoding error: %s", e)
         current_span.set_status(trace.Status(trace.StatusCode.ERROR,
                                               f"JSON Decode Error: {e}"))
     except Exception as e:
         logger.critical("An unexpected error occurred: %s", e, exc_info=True)
         current_span.set_status(trace.Status(trace.StatusCode.ERROR,
                                               f"Unexpected Error: {e}"))
+    finally:
+        if current_span.is_recording():
+            current_span.set_attributes(attrs)
 
 async def main():
     """
@@ -114,19 +296,30 @@ async def main():
     """
     logger.info("Application starting...")
     # This creates a root span for the entire application execution
-    with tracer.start_as_current_span("main_application_run") as main_span:
-        # Run both functions concurrently
-        logger.info("Running wait_half_second and call_demo_endpoint in parallel...")
-        await asyncio.gather(
-            wait_half_second(),
-            call_demo_endpoint()
-        )
-        main_span.set_attribute("app.status", "completed_parallel_tasks")
+    try:
+        with tracer.start_as_current_span("main_application_run") as main_span:
+            # Run both functions concurrently
+            logger.info("Running wait_half_second and call_demo_endpoint in parallel...")
+            await asyncio.gather(
+                wait_half_second(),
+                call_demo_endpoint()
+            )
+            main_span.set_attribute("app.status", "completed_parallel_tasks")
+    finally:
+        # The client's pool is bound to this event loop, so close it before the loop exits
+        await close_http_client()
     logger.info("Application finished.")
 
 if __name__ == "__main__":
-    configure_opentelemetry()
-    asyncio.run(main())
-    # It's important to shut down the provider to ensure all buffered spans are sent
-    trace.get_tracer_provider().shutdown()
-    logger.info("OpenTelemetry provider shut down.")
\ No newline at end of file
+    provider = configure_opentelemetry()
+    try:
+        if uvloop is not None:
+            uvloop.run(main())
+        else:
+            asyncio.run(main())
+    finally:
+        # It's important to shut down the provider to ensure all buffered spans are sent,
+        # including those of a failed or interrupted run. The wait is capped so a hung
+        # Cloud Trace endpoint can't stall exit.
+        if shutdown_tracing(provider):
+            logger.info("OpenTelemetry provider shut down.")
\ No newline at end of file